@@ -2,9 +2,13 @@
 from __future__ import annotations
 
 import argparse
+import hashlib
+import io
+import os
 import re
 import sys
-from dataclasses import dataclass
+from collections.abc import Callable, Iterator
+from dataclasses import dataclass, field
 from pathlib import Path
 
 
@@ -19,6 +23,16 @@ class Args:
     version: str
     generated: Path | None
     repo_root: Path
+    force: bool
+    # Per-run cache of normalized header bytes, keyed by resolved path.
+    sources: dict[Path, bytes] = field(default_factory=dict, repr=False)
+    # Per-run cache of each header's '#include' matches, filled by the dependency
+    # scan so inlining does not run the include regex over every header again.
+    includes: dict[Path, list[re.Match[bytes]]] = field(
+        default_factory=dict, repr=False
+    )
+    # Per-run cache of resolve_local() results, keyed by include fragment.
+    resolved: dict[str, Path | None] = field(default_factory=dict, repr=False)
 
 
 def parse_args(argv: list[str]) -> Args:
@@ -44,6 +58,11 @@ def parse_args(argv: list[str]) -> Args:
         "--generated",
         help="Build include dir containing generated/byteweave/version.hpp",
     )
+    p.add_argument(
+        "--force",
+        action="store_true",
+        help="Regenerate even if the output's .stamp file says it is up to date",
+    )
     ns = p.parse_args(argv)
 
     script_dir = Path(__file__).resolve().parent
@@ -63,6 +82,7 @@ def parse_args(argv: list[str]) -> Args:
         version=ns.version,
         generated=generated,
         repo_root=repo_root,
+        force=ns.force,
     )
 
 
@@ -70,26 +90,44 @@ LOCAL_PREFIX = "byteweave/"
 EXPORT_HEADER = f"{LOCAL_PREFIX}export.hpp"
 VERSION_HEADER = f"{LOCAL_PREFIX}version.hpp"
 
-_include_rx = re.compile(r'^\s*#\s*include\s*([<"])([^">]+)[>"]')
+# Matches a whole '#include' line (with its newline); group 1 is the include path.
+_include_rx = re.compile(
+    rb'^[ \t]*#[ \t]*include[ \t]*[<"]([^">\n]+)[>"][^\n]*\n?', re.MULTILINE
+)
+# Matches a '#pragma once' line (group 1) preceded only by blank lines and
+# comments; a '/* ... */' block may span lines but never runs past its first '*/'.
+_pragma_once_rx = re.compile(
+    rb"(?:(?:[ \t]*(?://[^\n]*|/\*(?:[^*]|\*(?!/))*\*/))*[ \t]*\n)*"
+    rb"([ \t]*#[ \t]*pragma[ \t]+once\b[^\n]*\n?)"
+)
+_semver_rx = re.compile(r"^\s*(\d+)\.(\d+)\.(\d+)\s*$")
 
+OUTPUT_BUFFER = 1 << 20
 
-def parse_include(line: str) -> tuple[str, str] | None:
-    m = _include_rx.match(line)
-    if not m:
-        return None
-    return m.group(1), m.group(2).strip()
+
+def normalize_newlines(s: bytes) -> bytes:
+    return s.replace(b"\r\n", b"\n").replace(b"\r", b"\n")
 
 
-def is_local_byteweave(path: str) -> bool:
-    return path.startswith(LOCAL_PREFIX)
+def strip_pragma_once(text: bytes) -> bytes:
+    # The pragma only ever appears in a header's prologue, so look no further.
+    m = _pragma_once_rx.match(text)
+    if not m:
+        return text
+    return text[: m.start(1)] + text[m.end(1) :]
 
 
-def normalize_newlines(s: str) -> str:
-    return s.replace("\r\n", "\n").replace("\r", "\n")
+def read_normalized(path: Path, cache: dict[Path, bytes]) -> bytes:
+    # Headers stay UTF-8 bytes end to end; only include paths are ever decoded.
+    text = cache.get(path)
+    if text is None:
+        _, text = load_header(path, None)
+        cache[path] = text
+    return text
 
 
 def version_triplet(version: str) -> tuple[int, int, int]:
-    m = re.match(r"^\s*(\d+)\.(\d+)\.(\d+)\s*$", version)
+    m = _semver_rx.match(version)
     if not m:
         raise AmalgamationError(f"Invalid --version '{version}'. Expected X.Y.Z")
     return int(m.group(1)), int(m.group(2)), int(m.group(3))
@@ -115,41 +153,233 @@ def resolve_local(
     raise AmalgamationError(f"Unable to resolve local include '{path_fragment}'")
 
 
-def inline_file(
-    path: Path, repo_root: Path, generated: Path | None, seen: set[Path]
+def resolve_cached(
+    path_fragment: str,
+    repo_root: Path,
+    generated: Path | None,
+    resolved: dict[str, Path | None],
+) -> Path | None:
+    if path_fragment in resolved:
+        return resolved[path_fragment]
+    target = resolve_local(path_fragment, repo_root, generated)
+    resolved[path_fragment] = target
+    return target
+
+
+def load_header(
+    path: Path, st: os.stat_result | None
+) -> tuple[os.stat_result, bytes]:
+    # Stat before reading so an edit racing the read still changes the digest.
+    if st is None:
+        try:
+            st = os.stat(path)
+        except FileNotFoundError:
+            raise AmalgamationError(f"Missing input file: {path}") from None
+    return st, strip_pragma_once(normalize_newlines(path.read_bytes()))
+
+
+def list_dependencies(
+    entry: Path,
+    entry_st: os.stat_result,
+    repo_root: Path,
+    generated: Path | None,
+    cache: dict[Path, bytes],
+    includes: dict[Path, list[re.Match[bytes]]],
+    resolved: dict[str, Path | None],
+) -> list[tuple[Path, os.stat_result]]:
+    # Include-graph scan only: no concatenation, just every header that would be
+    # inlined. Headers are read serially; the per-header work is mostly regex and
+    # bytes munging under the GIL, so a thread pool only adds overhead.
+    deps: list[tuple[Path, os.stat_result]] = []
+    seen: set[str] = {str(entry)}
+    stack: list[tuple[Path, os.stat_result | None]] = [(entry, entry_st)]
+    while stack:
+        path, st = stack.pop()
+        st, text = load_header(path, st)
+        cache[path] = text
+        matches = includes[path] = list(_include_rx.finditer(text))
+        deps.append((path, st))
+        for m in matches:
+            inc = m.group(1).decode("utf-8").strip()
+            if not inc.startswith(LOCAL_PREFIX):
+                continue
+            target = resolve_cached(inc, repo_root, generated, resolved)
+            if target is None:
+                continue
+            key = str(target)
+            if key in seen or key == "__SYNTHESIZE_VERSION__":
+                continue
+            seen.add(key)
+            stack.append((target, None))
+    return deps
+
+
+def input_digest(
+    args: Args, needs_version: bool, deps: list[tuple[Path, os.stat_result]]
 ) -> str:
-    if path in seen:
-        return ""
-    if str(path) == "__SYNTHESIZE_VERSION__":
-        return ""
-    if not path.exists():
+    h = hashlib.sha256()
+    h.update(
+        f"{args.entry}\0{args.version}\0{args.generated}\0{needs_version}\0".encode()
+    )
+    script = Path(__file__).resolve()
+    inputs = [*deps, (script, os.stat(script))]
+    for path, st in sorted(inputs, key=lambda d: str(d[0])):
+        h.update(f"{path}\0{st.st_mtime_ns}\0{st.st_size}\n".encode())
+    return h.hexdigest()
+
+
+def read_stamp(stamp: Path) -> tuple[str, list[Path]] | None:
+    # Stamp layout: the input digest, then one inlined header path per line.
+    try:
+        lines = stamp.read_text(encoding="utf-8").splitlines()
+    except FileNotFoundError:
+        return None
+    if not lines:
+        return None
+    return lines[0], [Path(p) for p in lines[1:]]
+
+
+def write_stamp(
+    stamp: Path, digest: str, deps: list[tuple[Path, os.stat_result]]
+) -> None:
+    lines = [digest, *(str(path) for path, _ in deps)]
+    stamp.write_text("\n".join(lines) + "\n", encoding="utf-8")
+
+
+def stamp_is_current(
+    args: Args, needs_version: bool, entry_st: os.stat_result, stamp: Path
+) -> bool:
+    # Stat-only check against the headers the previous run recorded; no header
+    # is read unless something changed.
+    recorded = read_stamp(stamp)
+    if recorded is None:
+        return False
+    digest, paths = recorded
+    deps: list[tuple[Path, os.stat_result]] = []
+    for path in paths:
+        try:
+            st = entry_st if path == args.entry else os.stat(path)
+        except FileNotFoundError:
+            return False
+        deps.append((path, st))
+    return input_digest(args, needs_version, deps) == digest
+
+
+@dataclass
+class _Frame:
+    text: bytes
+    matches: Iterator[re.Match[bytes]]
+    pos: int = 0
+    # End marker emitted once this header is exhausted (None for the entry).
+    closing: bytes | None = None
+    # Number of segments written when this header started, to detect empty bodies.
+    mark: int = 0
+
+
+def open_frame(
+    path: Path,
+    seen: set[str],
+    cache: dict[Path, bytes],
+    includes: dict[Path, list[re.Match[bytes]]],
+    closing: bytes | None,
+    mark: int,
+) -> _Frame | None:
+    key = str(path)
+    if key in seen:
+        return None
+    if key == "__SYNTHESIZE_VERSION__":
+        return None
+    # Headers cached by the dependency scan are known to exist.
+    if path not in cache and not path.exists():
         raise AmalgamationError(f"Missing input file: {path}")
-    seen.add(path)
-    text = normalize_newlines(path.read_text(encoding="utf-8"))
-    out_lines: list[str] = []
-    for line in text.splitlines():
-        if line.strip().startswith("#pragma once"):
-            continue
-        parsed = parse_include(line)
-        if not parsed:
-            out_lines.append(line)
+    seen.add(key)
+    text = read_normalized(path, cache)
+    known = includes.get(path)
+    matches = iter(known) if known is not None else _include_rx.finditer(text)
+    return _Frame(text, matches, closing=closing, mark=mark)
+
+
+def inline_file(
+    path: Path,
+    repo_root: Path,
+    generated: Path | None,
+    seen: set[str],
+    cache: dict[Path, bytes],
+    includes: dict[Path, list[re.Match[bytes]]],
+    resolved: dict[str, Path | None],
+    write: Callable[[bytes], object],
+) -> None:
+    written = 0
+    last = b""
+
+    def emit(segment: bytes) -> None:
+        nonlocal written, last
+        write(segment)
+        written += 1
+        last = segment
+
+    def close_include(mark: int, closing: bytes) -> None:
+        # Keep the end marker on its own line even for empty/unterminated headers.
+        if written == mark or not last.endswith(b"\n"):
+            emit(b"\n")
+        emit(closing)
+
+    # Depth-first walk with an explicit stack; each frame resumes its header
+    # after the include that suspended it.
+    root = open_frame(path, seen, cache, includes, None, 0)
+    stack = [root] if root is not None else []
+    while stack:
+        frame = stack[-1]
+        m = next(frame.matches, None)
+        if m is None:
+            if frame.pos < len(frame.text):
+                emit(frame.text[frame.pos :])
+            stack.pop()
+            if frame.closing is not None:
+                close_include(frame.mark, frame.closing)
             continue
-        _, inc = parsed
+        if m.start() > frame.pos:
+            emit(frame.text[frame.pos : m.start()])
+        frame.pos = m.end()
+        inc = m.group(1).decode("utf-8").strip()
         # Inline any include under byteweave/ (regardless of <> or "")
-        if not is_local_byteweave(inc):
-            out_lines.append(line)
+        if not inc.startswith(LOCAL_PREFIX):
+            emit(m.group(0))
             continue
         if inc == EXPORT_HEADER:
             continue
-        target = resolve_local(inc, repo_root, generated)
+        target = resolve_cached(inc, repo_root, generated, resolved)
         if target is None:
             continue
         if str(target) == "__SYNTHESIZE_VERSION__":
             continue
-        out_lines.append(f"// begin: {inc}")
-        out_lines.append(inline_file(target, repo_root, generated, seen))
-        out_lines.append(f"// end: {inc}")
-    return "\n".join(out_lines)
+        emit(f"// begin: {inc}\n".encode())
+        closing = f"// end: {inc}".encode()
+        if m.group(0).endswith(b"\n"):
+            closing += b"\n"
+        child = open_frame(target, seen, cache, includes, closing, written)
+        if child is None:
+            close_include(written, closing)
+        else:
+            stack.append(child)
+
+
+class RStripWriter:
+    """Binary writer that drops trailing whitespace from the stream, like rstrip()."""
+
+    def __init__(self, fh: io.BufferedIOBase) -> None:
+        self._fh = fh
+        self._pending = b""
+
+    def write(self, s: bytes) -> int:
+        kept = s.rstrip()
+        if kept:
+            self._fh.write(self._pending)
+            self._fh.write(kept)
+            self._pending = s[len(kept) :]
+        else:
+            self._pending += s
+        return len(s)
 
 
 def version_text(version: str) -> str:
@@ -177,28 +407,71 @@ def build_preamble() -> str:
 
 def main() -> None:
     args = parse_args(sys.argv[1:])
-    if not args.entry.exists():
-        raise AmalgamationError(f"--entry not found: {args.entry}")
-    if args.generated is not None and not args.generated.exists():
-        raise AmalgamationError(f"--generated directory not found: {args.generated}")
-    seen: set[Path] = set()
-    body = inline_file(args.entry, args.repo_root, args.generated, seen)
+    try:
+        entry_st = os.stat(args.entry)
+    except FileNotFoundError:
+        raise AmalgamationError(f"--entry not found: {args.entry}") from None
+    if args.generated is not None:
+        try:
+            os.stat(args.generated)
+        except FileNotFoundError:
+            raise AmalgamationError(
+                f"--generated directory not found: {args.generated}"
+            ) from None
     needs_version = True
     if args.generated is not None:
         gen_version = (args.generated / VERSION_HEADER).resolve()
         if gen_version.exists():
             needs_version = False
-    if "BYTEWEAVE_VERSION_MAJOR" in body:
-        needs_version = False
-    preamble = build_preamble()
-    pieces: list[str] = [preamble]
-    if needs_version:
-        pieces.append("// synthesized: byteweave/version.hpp")
-        pieces.append(version_text(args.version))
-    pieces.append(body)
-    out_text = "\n".join(pieces).rstrip() + "\n"
+    stamp = args.out.with_name(args.out.name + ".stamp")
+    if (
+        not args.force
+        and args.out.exists()
+        and stamp_is_current(args, needs_version, entry_st, stamp)
+    ):
+        # Build tools also list headers that are never inlined (export.hpp) as
+        # inputs; bump the output's mtime so they see it as fresh again.
+        os.utime(args.out)
+        print(f"{args.out} is up to date")
+        return
+    deps = list_dependencies(
+        args.entry,
+        entry_st,
+        args.repo_root,
+        args.generated,
+        args.sources,
+        args.includes,
+        args.resolved,
+    )
+    digest = input_digest(args, needs_version, deps)
+    seen: set[str] = set()
     args.out.parent.mkdir(parents=True, exist_ok=True)
-    args.out.write_text(out_text, encoding="utf-8")
+    # Stream into a sibling temp file so a failed run never leaves a truncated header.
+    tmp = args.out.with_name(args.out.name + ".tmp")
+    try:
+        with tmp.open("wb", buffering=OUTPUT_BUFFER) as fh:
+            w = RStripWriter(fh)
+            w.write(build_preamble().encode())
+            w.write(b"\n")
+            if needs_version:
+                w.write(b"// synthesized: byteweave/version.hpp\n")
+                w.write(version_text(args.version).encode())
+                w.write(b"\n")
+            inline_file(
+                args.entry,
+                args.repo_root,
+                args.generated,
+                seen,
+                args.sources,
+                args.includes,
+                args.resolved,
+                w.write,
+            )
+            fh.write(b"\n")
+        os.replace(tmp, args.out)
+    finally:
+        tmp.unlink(missing_ok=True)
+    write_stamp(stamp, digest, deps)
     print(f"Wrote single header to {args.out}")
 
 
@@ -22,6 +22,7 @@ import argparse
 import concurrent.futures as futures
 import fnmatch
 import os
+import re
 import subprocess
 import sys
 from pathlib import Path
@@ -30,8 +31,24 @@ from pathlib import Path
 FILE_GLOBS: list[str] = ["**/*.cpp", "**/*.hpp", "**/*.inl"]
 EXCLUDE_GLOBS: list[str] = ["**/*.hpp.in"]
 EXCLUDE_DIRS: list[str] = [".git", "build", "dist", "out", "cmake-build*"]
+BATCH_SIZE: int = 16  # max files per clang-format invocation
 # -----------------------------------------------------------------------------
 
+# The file globs above are all of the form "**/*<suffix>", so matching reduces to
+# a str.endswith() check on the file name. Like fnmatch, both sides go through
+# os.path.normcase so matching stays case-insensitive on Windows.
+FILE_SUFFIXES: tuple[str, ...] = tuple(
+    os.path.normcase(g.rsplit("*", 1)[-1]) for g in FILE_GLOBS
+)
+EXCLUDE_SUFFIXES: tuple[str, ...] = tuple(
+    os.path.normcase(g.rsplit("*", 1)[-1]) for g in EXCLUDE_GLOBS
+)
+# All EXCLUDE_DIRS patterns compiled once into a single alternation; names are
+# matched after os.path.normcase, as fnmatch.fnmatch does.
+EXCLUDE_DIR_RX = re.compile(
+    "|".join(fnmatch.translate(os.path.normcase(p)) for p in EXCLUDE_DIRS)
+)
+
 
 def infer_repo_root(default: Path) -> Path:
     """Prefer git root; fallback to provided default."""
@@ -44,41 +61,35 @@ def infer_repo_root(default: Path) -> Path:
         return default
 
 
-def is_under_excluded_dir(p: Path, root: Path) -> bool:
-    """Return True if any path component matches EXCLUDE_DIRS patterns."""
-    rel = p.relative_to(root)
-    for part in rel.parts[:-1]:  # exclude the filename itself
-        for pat in EXCLUDE_DIRS:
-            if fnmatch.fnmatch(part, pat):
-                return True
-    return False
-
-
 def collect_files(root: Path) -> list[Path]:
-    """Collect files matching FILE_GLOBS, minus EXCLUDE_GLOBS and EXCLUDE_DIRS."""
-    files: set[Path] = set()
-    for pattern in FILE_GLOBS:
-        for p in root.glob(pattern):
-            if not p.is_file():
-                continue
-            if is_under_excluded_dir(p, root):
+    """
+    Collect files matching FILE_GLOBS, minus EXCLUDE_GLOBS and EXCLUDE_DIRS.
+    Excluded directories are pruned during the walk, so they are never descended.
+    """
+    files: list[Path] = []
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames[:] = [
+            d for d in dirnames if not EXCLUDE_DIR_RX.match(os.path.normcase(d))
+        ]
+        base = Path(dirpath)
+        for name in filenames:
+            key = os.path.normcase(name)
+            if not key.endswith(FILE_SUFFIXES):
                 continue
             # Per-file excludes
-            skip = any(
-                fnmatch.fnmatch(str(p.relative_to(root)), pat) for pat in EXCLUDE_GLOBS
-            )
-            if skip:
+            if key.endswith(EXCLUDE_SUFFIXES):
                 continue
-            files.add(p)
+            files.append(base / name)
     return sorted(files)
 
 
 def run_clang_format(
-    clang_format: str, file: Path, check: bool
-) -> tuple[Path, int, str, str]:
+    clang_format: str, files: list[Path], check: bool
+) -> list[tuple[Path, int, str, str]]:
     """
-    Run clang-format on a single file.
-    Returns (file, returncode, stdout, stderr).
+    Run clang-format on a batch of files in one process.
+    If the batch fails, each file is re-run on its own so results stay per-file.
+    Returns a list of (file, returncode, stdout, stderr).
     """
     args = [clang_format, "-style=file"]
     if check:
@@ -88,11 +99,15 @@ def run_clang_format(
         # In-place edit
         args += ["-i"]
 
-    args.append(str(file))
+    args.extend(str(f) for f in files)
     proc = subprocess.run(
         args, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True
     )
-    return file, proc.returncode, proc.stdout, proc.stderr
+    if proc.returncode == 0:
+        return [(f, 0, "", "") for f in files]
+    if len(files) == 1:
+        return [(files[0], proc.returncode, proc.stdout, proc.stderr)]
+    return [r for f in files for r in run_clang_format(clang_format, [f], check)]
 
 
 def main(argv: list[str]) -> int:
@@ -134,18 +149,25 @@ def main(argv: list[str]) -> int:
     would_change: list[Path] = []
     failures: list[tuple[Path, str]] = []
 
+    # Batch files to amortize process startup, but keep enough batches to use all jobs.
+    batch = max(1, min(BATCH_SIZE, -(-len(files) // max(1, args.jobs))))
+    chunks = [files[i : i + batch] for i in range(0, len(files), batch)]
+
     with futures.ThreadPoolExecutor(max_workers=args.jobs) as ex:
-        futs = [ex.submit(run_clang_format, args.clang_format, f, check) for f in files]
+        futs = [
+            ex.submit(run_clang_format, args.clang_format, chunk, check)
+            for chunk in chunks
+        ]
         for fut in futures.as_completed(futs):
-            file, code, out, err = fut.result()
-            if code == 0:
-                continue
-            # clang-format returns non-zero if reformat would occur (with -n --Werror) OR on error.
-            # Heuristics: if stderr empty, we assume "would change", else surface error.
-            if check and not err.strip():
-                would_change.append(file)
-            else:
-                failures.append((file, (err or out).strip()))
+            for file, code, out, err in fut.result():
+                if code == 0:
+                    continue
+                # clang-format returns non-zero if reformat would occur (with -n --Werror) OR on error.
+                # Heuristics: if stderr empty, we assume "would change", else surface error.
+                if check and not err.strip():
+                    would_change.append(file)
+                else:
+                    failures.append((file, (err or out).strip()))
 
     if check:
         if failures:
@@ -11,6 +11,7 @@ Usage (CI or local):
 Notes:
   - Respects .clang-tidy in the repo.
   - By default runs on all TUs found in compile_commands.json.
+  - Header diagnostics follow HeaderFilterRegex in .clang-tidy unless --header-filter is given.
 """
 
 from __future__ import annotations
@@ -25,6 +26,11 @@ from dataclasses import dataclass
 from pathlib import Path
 from typing import Iterable
 
+try:  # optional; decodes large compile_commands.json files considerably faster
+    import orjson
+except ImportError:
+    orjson = None
+
 DEFAULT_JOBS = max(os.cpu_count() or 2, 2)
 
 @dataclass
@@ -35,6 +41,7 @@ class Args:
     clang_tidy: str
     extra: list[str]
     warnings_as_errors: bool
+    header_filter: str              # optional -header-filter override ('' = use .clang-tidy)
 
 def parse_args(argv: list[str]) -> Args:
     ap = argparse.ArgumentParser(description="Run clang-tidy using compile_commands.json")
@@ -42,6 +49,7 @@ def parse_args(argv: list[str]) -> Args:
     ap.add_argument("--jobs", "-j", type=int, default=DEFAULT_JOBS, help="Parallelism")
     ap.add_argument("--clang-tidy", default=os.environ.get("CLANG_TIDY", "clang-tidy"), help="clang-tidy binary")
     ap.add_argument("--warnings-as-errors", action="store_true", help="Pass -warnings-as-errors=* to clang-tidy")
+    ap.add_argument("--header-filter", default="", help="Override .clang-tidy's HeaderFilterRegex with this regex")
     ap.add_argument("files", nargs="*", help="Optional explicit file list (otherwise all from compile_commands.json)")
     # Allow extra args after '--'
     if "--" in argv:
@@ -72,11 +80,13 @@ def parse_args(argv: list[str]) -> Args:
         clang_tidy=ns.clang_tidy,
         extra=extra,
         warnings_as_errors=bool(ns.warnings_as_errors),
+        header_filter=ns.header_filter,
     )
 
 def load_tus(build_dir: Path) -> list[str]:
     compdb = build_dir / "compile_commands.json"
-    data = json.loads(compdb.read_text(encoding="utf-8"))
+    raw = compdb.read_bytes()
+    data = orjson.loads(raw) if orjson is not None else json.loads(raw)
     files: list[str] = []
     seen: set[str] = set()
     for entry in data:
@@ -90,8 +100,10 @@ def load_tus(build_dir: Path) -> list[str]:
             files.append(fp)
     return files
 
-def run_one(clang_tidy: str, build_dir: Path, file: str, extra: list[str], warnings_as_errors: bool) -> int:
+def run_one(clang_tidy: str, build_dir: Path, file: str, extra: list[str], warnings_as_errors: bool, header_filter: str) -> int:
     cmd = [clang_tidy, "-quiet", "-p", str(build_dir)]
+    if header_filter:
+        cmd.append(f"-header-filter={header_filter}")
     if warnings_as_errors:
         cmd.append("-warnings-as-errors=*")
     cmd.append(file)
@@ -114,8 +126,8 @@ def main(argv: list[str]) -> int:
         return 0
 
     rc = 0
-    with ThreadPoolExecutor(max_workers=args.jobs) as ex:
-        futs = {ex.submit(run_one, args.clang_tidy, args.p, f, args.extra, args.warnings_as_errors): f for f in files}
+    with ThreadPoolExecutor(max_workers=min(args.jobs, len(files))) as ex:
+        futs = {ex.submit(run_one, args.clang_tidy, args.p, f, args.extra, args.warnings_as_errors, args.header_filter): f for f in files}
         for fut in as_completed(futs):
             code = fut.result()
             if code != 0: